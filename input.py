@@ -1,18 +1,31 @@
 # Standard
-import json
 import configparser
 from datetime import datetime
+from functools import lru_cache
 # External
 import pytz
 # Internal
-from shared import handle_error
+from shared import handle_error, parse_json
+
+
+@lru_cache(maxsize=1)
+def load_config():
+    # Parse config.ini once, later handlers reuse the same parser
+    config = configparser.ConfigParser(inline_comment_prefixes="#")
+    config.read('config.ini')
+    return config
 
 
 class InputHandler:
+    # Settings handed to GameProcessor as keyword arguments
+    SETTINGS_KEYS = ("domain", "server_id", "start_date", "timezone", "user_aliases", "min_games_required",
+                     "last_days_threshold", "min_games_last_days", "discard_ties", "decay_enabled", "decay_amount",
+                     "grace_days", "max_decay_proportion", "default_sigma", "default_mu", "verbose_output", "top_x",
+                     "write_txt", "write_csv", "json_file")
+
     def __init__(self, args):
         self.args = args
-        self.config = configparser.ConfigParser(inline_comment_prefixes="#")
-        self.config.read('config.ini')
+        self.config = load_config()
         self.domain = None
         self.server_id = None
         self.start_date = None
@@ -41,7 +54,7 @@ class InputHandler:
         self.start_date = self.args.date_start or self.config.get('MANDATORY', 'DATE_START')
         timezone_in = self.args.timezone or self.config.get('SETTINGS', 'TIMEZONE')
         self.timezone = pytz.timezone(timezone_in)
-        self.user_aliases = json.loads(self.config.get('ALIAS_MAPPINGS', 'ALIASED_PLAYERS'))
+        self.user_aliases = parse_json(self.config.get('ALIAS_MAPPINGS', 'ALIASED_PLAYERS'))
 
         self.min_games_required = self.args.min_games or self.config.getint('PLAYER_FILTERING', 'MINIMUM_GAMES_REQUIRED')
         self.last_days_threshold = self.args.last_days_threshold or self.config.getint('PLAYER_FILTERING', 'LAST_DAYS_THRESHOLD')
@@ -95,25 +108,4 @@ class InputHandler:
             handle_error(ValueError("TS_DEFAULT_MU must be positive"), "Default mu for TrueSkill must be positive.")
 
     def get_settings(self):
-        return {
-            "domain": self.domain,
-            "server_id": self.server_id,
-            "start_date": self.start_date,
-            "timezone": self.timezone,
-            "user_aliases": self.user_aliases,
-            "min_games_required": self.min_games_required,
-            "last_days_threshold": self.last_days_threshold,
-            "min_games_last_days": self.min_games_last_days,
-            "discard_ties": self.discard_ties,
-            "decay_enabled": self.decay_enabled,
-            "decay_amount": self.decay_amount,
-            "grace_days": self.grace_days,
-            "max_decay_proportion": self.max_decay_proportion,
-            "default_sigma": self.default_sigma,
-            "default_mu": self.default_mu,
-            "verbose_output": self.verbose_output,
-            "top_x": self.top_x,
-            "write_txt": self.write_txt,
-            "write_csv": self.write_csv,
-            "json_file": self.json_file
-        }
+        return {key: getattr(self, key) for key in self.SETTINGS_KEYS}
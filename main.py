@@ -42,7 +42,6 @@ def main():
         settings = input_handler.get_settings()
 
         processor = GameProcessor(**settings)
-        processor.user_aliases = settings['user_aliases']
         processor.run()
     except Exception as init_variables_exception:
         handle_error(init_variables_exception, "Failed to initialize input variables")
@@ -1,7 +1,10 @@
 # Standard
+import csv
 import os
 import sys
 from datetime import datetime, timedelta
+from heapq import nlargest
+from operator import attrgetter
 # External
 from prettytable import PrettyTable
 
@@ -16,36 +19,32 @@ def display_ratings(processor, start_date_str, end_date_str, stream=sys.stdout):
     current_date = datetime.now(processor.timezone).date()
     start_date_threshold = current_date - timedelta(days=processor.last_days_threshold)
 
-    # Filter out players with less than the minimum required games played
-    initial_player_count = len(processor.player_ratings)
-    filtered_players = {user_id: data for user_id, data in processor.player_ratings.items() if
-                        data.games_played >= processor.min_games_required}
-    processor.filtered_by_min_games = initial_player_count - len(filtered_players)
-
-    # Filter based on last_days_threshold
-    if processor.last_days_threshold > 0:
-        initial_filtered_count = len(filtered_players)
-        filtered_players = {user_id: data for user_id, data in filtered_players.items()
-                            if data.last_played >= start_date_threshold}
-        processor.filtered_by_last_days = initial_filtered_count - len(filtered_players)
-
-        # Filter based on min_games_last_days
-        if processor.min_games_last_days > 0:
-            initial_filtered_count = len(filtered_players)
-            filtered_players = {user_id: data for user_id, data in filtered_players.items()
-                                if data.recent_games >= processor.min_games_last_days}
-            processor.filtered_by_min_games_last_days = initial_filtered_count - len(filtered_players)
-
-    # Sort players by their conservative TrueSkill rating (mu - 3 * sigma)
-    sorted_players = sorted(filtered_players.items(), key=lambda x: x[1].rating.mu - 3 * x[1].rating.sigma,
-                            reverse=True)
+    # Filter players, counting how many each filter removes
+    check_last_days = processor.last_days_threshold > 0
+    check_min_games_last_days = check_last_days and processor.min_games_last_days > 0
+    filtered_by_min_games = filtered_by_last_days = filtered_by_min_games_last_days = 0
+    filtered_players = []
+    for player in processor.player_ratings.values():
+        if player.games_played < processor.min_games_required:
+            filtered_by_min_games += 1
+        elif check_last_days and player.last_played < start_date_threshold:
+            filtered_by_last_days += 1
+        elif check_min_games_last_days and player.recent_games < processor.min_games_last_days:
+            filtered_by_min_games_last_days += 1
+        else:
+            filtered_players.append(player)
+    processor.filtered_by_min_games = filtered_by_min_games
+    processor.filtered_by_last_days = filtered_by_last_days
+    processor.filtered_by_min_games_last_days = filtered_by_min_games_last_days
 
     # Calculate the number of players below the cutoff
-    cutoff_count = max(0, len(sorted_players) - processor.top_x) if processor.top_x > 0 else 0
+    cutoff_count = max(0, len(filtered_players) - processor.top_x) if processor.top_x > 0 else 0
 
-    # Limit the number of players to display if processor.top_x is greater than 0
+    # Sort players by their conservative TrueSkill rating (mu - 3 * sigma), keeping the top processor.top_x
     if processor.top_x > 0:
-        sorted_players = sorted_players[:processor.top_x]
+        sorted_players = nlargest(processor.top_x, filtered_players, key=attrgetter('conservative'))
+    else:
+        sorted_players = sorted(filtered_players, key=attrgetter('conservative'), reverse=True)
 
     table = PrettyTable()
 
@@ -58,43 +57,26 @@ def display_ratings(processor, start_date_str, end_date_str, stream=sys.stdout):
 
     rows = []
 
-    for rank, (user_id, player) in enumerate(sorted_players, start=1):
-        rating = player.rating
-        games_played = player.games_played
-        wins = player.wins
-        losses = player.losses
-        last_played = player.last_played.strftime('%Y-%m-%d')
-        avg_pick_order = player.avg_pick_order
-        display_name = player.name
-
+    for rank, player in enumerate(sorted_players, start=1):
+        row = [
+            rank,
+            player.name,
+            f"{player.conservative:.2f}",
+            f"{player.mu:.2f}",
+            f"{player.sigma:.2f}",
+            player.games_played,
+            f"{player.wins}/{player.losses}",
+            player.last_played.isoformat(),  # YYYY-MM-DD
+            f"{player.avg_pick_order:.2f}"
+        ]
         if processor.verbose_output:
-            associated_ids = ",".join(player.secondary_ids)
-            row = [
-                rank,
-                display_name,
-                f"{rating.mu - 3 * rating.sigma:.2f}",  # Conservative rating estimate
-                f"{rating.mu:.2f}",
-                f"{rating.sigma:.2f}",
-                games_played,
-                f"{wins}/{losses}",
-                last_played,
-                f"{avg_pick_order:.2f}",
-                associated_ids
-            ]
-        else:
-            row = [
-                rank,
-                display_name,
-                f"{rating.mu - 3 * rating.sigma:.2f}",  # Conservative rating estimate
-                f"{rating.mu:.2f}",
-                f"{rating.sigma:.2f}",
-                games_played,
-                f"{wins}/{losses}",
-                last_played,
-                f"{avg_pick_order:.2f}"
-            ]
+            row.append(",".join(player.secondary_ids))
         rows.append(row)
-        table.add_row(row)
+
+    # Add the rows to the table
+    table.add_rows(rows)
+    # Render the table for the console and the text file
+    table_string = table.get_string()
 
     decay_settings = ""
     if processor.decay_enabled:
@@ -109,7 +91,7 @@ def display_ratings(processor, start_date_str, end_date_str, stream=sys.stdout):
 
     print(f"Games period: From {start_date_str} to {end_date_str}", file=stream)
     print(f"Games used: {processor.games_used_count}", file=stream)
-    print(table, file=stream)
+    print(table_string, file=stream)
     print(f"Sigma decay: {decay_settings if processor.decay_enabled else 'Disabled'}", file=stream)
     print(f"Minimum games required: {processor.min_games_required} "
           f"({processor.filtered_by_min_games} players filtered)", file=stream)
@@ -133,37 +115,35 @@ def display_ratings(processor, start_date_str, end_date_str, stream=sys.stdout):
     if processor.write_txt:
         txt_filename = f"out/player_ratings_{timestamp}.txt"
         ensure_directory_exists(txt_filename)
+        lines = []
+        if processor.verbose_output:
+            lines.append(f"Input URL: {processor.url}\n")
+            lines.append(f"Server ID: {processor.server_id}\n")
+        lines.append(f"Games period: From {start_date_str} to {end_date_str}\n")
+        lines.append(f"Games used: {processor.games_used_count}\n")
+        lines.append(table_string)
+        lines.append(f"\nRating decay: {decay_settings if processor.decay_enabled else 'Disabled'}\n")
+        lines.append(f"Minimum games required: {processor.min_games_required} "
+                     f"({processor.filtered_by_min_games} players filtered)\n")
+        if processor.last_days_threshold > 0:
+            lines.append(f"Last days threshold: {processor.last_days_threshold} "
+                         f"({processor.filtered_by_last_days} players filtered)\n")
+            if processor.min_games_last_days > 0:
+                lines.append(f"Min games in last days threshold: {processor.min_games_last_days} "
+                             f"({processor.filtered_by_min_games_last_days} players filtered)\n")
+        if processor.top_x > 0:
+            lines.append(f"Showing top {processor.top_x} players ({cutoff_count} cutoff)\n")
+        lines.append(f"Ties discarded: {processor.discard_ties}\n")
+        lines.append(f"Aliased player/s: {', '.join(processor.user_aliases.keys())}\n")
         with open(txt_filename, "w", encoding="utf-8") as text_file:
-            if processor.verbose_output:
-                text_file.write(f"Input URL: {processor.url}\n")
-                text_file.write(f"Server ID: {processor.server_id}\n")
-            text_file.write(f"Games period: From {start_date_str} to {end_date_str}\n")
-            text_file.write(f"Games used: {processor.games_used_count}\n")
-            text_file.write(str(table))
-            text_file.write(f"\nRating decay: {decay_settings if processor.decay_enabled else 'Disabled'}\n")
-            text_file.write(f"Minimum games required: {processor.min_games_required} "
-                            f"({processor.filtered_by_min_games} players filtered)\n")
-            if processor.last_days_threshold > 0:
-                text_file.write(f"Last days threshold: {processor.last_days_threshold} "
-                                f"({processor.filtered_by_last_days} players filtered)\n")
-                if processor.min_games_last_days > 0:
-                    text_file.write(f"Min games in last days threshold: {processor.min_games_last_days} "
-                                    f"({processor.filtered_by_min_games_last_days} players filtered)\n")
-            if processor.top_x > 0:
-                text_file.write(f"Showing top {processor.top_x} players ({cutoff_count} cutoff)\n")
-            text_file.write(f"Ties discarded: {processor.discard_ties}\n")
-            text_file.write(f"Aliased player/s: {', '.join(processor.user_aliases.keys())}\n")
+            text_file.writelines(lines)
 
     # Save the table to a CSV file if enabled
     if processor.write_csv:
         csv_filename = f"out/player_ratings_{timestamp}.csv"
         ensure_directory_exists(csv_filename)
-        with open(csv_filename, "w", encoding="utf-8") as csv_file:
-            if processor.verbose_output:
-                csv_file.write("Rank,Name,Trueskill Rating (μ - 3*σ),μ (mu),σ (sigma),Games Played,"
-                               "Win/Loss,Last Played,Avg Pick Order,Discord ID/s\n")
-            else:
-                csv_file.write("Rank,Name,Trueskill Rating (μ - 3*σ),μ (mu),σ (sigma),Games Played,"
-                               "Win/Loss,Last Played,Avg Pick Order\n")
-            for row in rows:
-                csv_file.write(",".join(map(str, row)) + "\n")
+        with open(csv_filename, "w", encoding="utf-8", newline="") as csv_file:
+            # csv.writer quotes fields containing commas, such as the joined Discord IDs
+            csv_writer = csv.writer(csv_file, lineterminator="\n")
+            csv_writer.writerow(table.field_names)
+            csv_writer.writerows(rows)
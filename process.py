@@ -1,19 +1,25 @@
 # Standard
+import math
 import requests
-import json
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
+from operator import itemgetter
 # External
-from trueskill import Rating, rate
+from requests.adapters import HTTPAdapter, Retry
+from trueskill import Rating, TrueSkill, calc_draw_margin
 # Internal
 from output import display_ratings
-from shared import handle_error
+from shared import handle_error, parse_json
 
 
 class Player:
+    __slots__ = ('user_id', 'name', 'mu', 'sigma', 'games_played', 'wins', 'losses', 'last_played', 'secondary_ids',
+                 'total_pick_order', 'pick_order_count', 'recent_games')
+
     def __init__(self, user_id, user_name, default_mu, default_sigma):
         self.user_id = user_id
         self.name = user_name
-        self.rating = Rating(mu=default_mu, sigma=default_sigma)
+        self.mu = default_mu
+        self.sigma = default_sigma
         self.games_played = 0
         self.wins = 0
         self.losses = 0
@@ -21,13 +27,26 @@ class Player:
         self.secondary_ids = set()
         self.total_pick_order = 0
         self.pick_order_count = 0
-        self.avg_pick_order = 0.0
         self.recent_games = 0
 
+    # trueskill Rating built from the stored mu and sigma
+    @property
+    def rating(self):
+        return Rating(mu=self.mu, sigma=self.sigma)
+
+    @property
+    def avg_pick_order(self):
+        # Average pick order over the games it was recorded for
+        return self.total_pick_order / self.pick_order_count if self.pick_order_count else 0.0
+
+    @property
+    def conservative(self):
+        # Conservative TrueSkill rating estimate (mu - 3 * sigma)
+        return self.mu - 3 * self.sigma
+
     def update_pick_order(self, pick_order):
         self.total_pick_order += pick_order
         self.pick_order_count += 1
-        self.avg_pick_order = self.total_pick_order / self.pick_order_count
 
     def add_game(self, is_win, current_date, is_recent_game):
         self.games_played += 1
@@ -35,17 +54,16 @@ class Player:
             self.wins += 1
         else:
             self.losses += 1
-        if self.last_played is None or current_date > self.last_played:
-            self.last_played = current_date
+        # Games are processed in completion order, so the latest game is always the last one seen
+        self.last_played = current_date
         if is_recent_game:
             self.recent_games += 1
 
     def apply_sigma_decay(self, decay_amount, max_decay_proportion, inactivity_days, default_sigma):
-        max_sigma_increase = default_sigma * max_decay_proportion - self.rating.sigma
+        max_sigma_increase = default_sigma * max_decay_proportion - self.sigma
         if max_sigma_increase > 0:
             total_decay = min(decay_amount * inactivity_days, max_sigma_increase)
-            new_sigma = self.rating.sigma + total_decay
-            self.rating = Rating(mu=self.rating.mu, sigma=new_sigma)
+            self.sigma += total_decay
 
 
 class GameProcessor:
@@ -73,60 +91,68 @@ class GameProcessor:
         self.write_csv = write_csv
         self.json_file = json_file
         self.url = f"{self.domain}/api/server/{self.server_id}/games/{self.start_date}"
+        # TrueSkill environment with the library defaults
+        self.ts_env = TrueSkill()
+        self.session = requests.Session()
+        # Retry dropped connections and transient server errors with a short backoff
+        retry_adapter = HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3,
+                                                      status_forcelist=(500, 502, 503, 504)))
+        self.session.mount('http://', retry_adapter)
+        self.session.mount('https://', retry_adapter)
         self.player_ratings = {}
-        self.primary_ids_cache = {}
         self.games_used_count = 0
         self.user_aliases = user_aliases
+        # Map every aliased ID to its primary name
+        self.alias_to_primary = {alias: primary_name for primary_name, aliases in user_aliases.items()
+                                 for alias in aliases}
         self.filtered_by_min_games = 0
         self.filtered_by_last_days = 0
         self.filtered_by_min_games_last_days = 0
+        # UTC bounds in ms of the most recently converted local day and its date
+        self.local_day_bounds = (0, 0, None)
 
     def fetch_game_data(self):
         try:
-            response = requests.get(self.url)
+            response = self.session.get(self.url, timeout=30)
             response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
+            return parse_json(response.content)
+        # Invalid JSON in the response raises a ValueError
+        except (requests.RequestException, ValueError) as e:
             handle_error(e, f"Failed to fetch data from {self.url}")
 
     def read_game_data_from_file(self):
         try:
-            with open(self.json_file, 'r') as file:
-                return json.load(file)
+            with open(self.json_file, 'rb') as file:
+                return parse_json(file.read())
         except Exception as e:
             handle_error(e, f"Failed to read game data from file {self.json_file}")
 
-    def get_primary_id(self, user_id):
-        if user_id in self.primary_ids_cache:
-            return self.primary_ids_cache[user_id]
-        for primary_name, aliases in self.user_aliases.items():
-            if user_id in aliases:
-                self.primary_ids_cache[user_id] = primary_name
-                return primary_name
-        self.primary_ids_cache[user_id] = user_id
-        return user_id
-
-    def get_player(self, user_id, user_name):
-        primary_id = self.get_primary_id(user_id)
-        if primary_id not in self.player_ratings:
-            self.player_ratings[primary_id] = Player(primary_id, user_name, self.default_mu, self.default_sigma)
-        return self.player_ratings[primary_id]
-
-    def process_game(self, game, played_dates):
+    def get_local_date(self, timestamp_ms):
+        # Consecutive games mostly share a day, so reuse the last day while the timestamp falls inside it
+        day_start, day_end, local_date = self.local_day_bounds
+        if day_start <= timestamp_ms < day_end:
+            return local_date
+        local_date = datetime.fromtimestamp(timestamp_ms / 1000, self.timezone).date()
+        day_start = self.timezone.localize(datetime.combine(local_date, time.min)).timestamp()
+        # An ambiguous midnight resolves to the earlier instant, so the cached day can only end too soon
+        day_end = self.timezone.localize(datetime.combine(local_date + timedelta(days=1), time.min),
+                                         is_dst=True).timestamp()
+        self.local_day_bounds = (int(day_start) * 1000, int(day_end) * 1000, local_date)
+        return local_date
+
+    def process_game(self, game, played_dates, threshold_date):
         current_date = None
         try:
-            current_date = datetime.fromtimestamp(game['completionTimestamp'] / 1000, self.timezone).date()
+            current_date = self.get_local_date(game['completionTimestamp'])
         except Exception as e:
             handle_error(e, f"Failed to convert timestamp for game {game}")
 
         # Track the dates on which games were played
-        if current_date not in played_dates:
-            played_dates[current_date] = set()
-        try:
-            for player in game['players']:
-                played_dates[current_date].add(player['user']['id'])
-        except KeyError:
-            handle_error(KeyError, f"Player ID not found in game data {game}")
+        played_dates.add(current_date)
+
+        # Bound lookups used for every player of the game
+        get_primary_id = self.alias_to_primary.get
+        get_rated_player = self.player_ratings.get
 
         try:
             winning_team = game['winningTeam']
@@ -135,72 +161,81 @@ class GameProcessor:
 
             self.games_used_count += 1
 
-            team1 = []
-            team2 = []
-            team1_ids = []
-            team2_ids = []
-
-            now_date = datetime.now(self.timezone).date()
-            threshold_date = now_date - timedelta(days=self.last_days_threshold)
+            # Players per team, indexed 0 for team 1 and 1 for team 2
+            team_players = ([], [])
+            team_wins = (winning_team == 1, winning_team == 2)
+            is_recent_game = current_date >= threshold_date
 
             for player_data in game['players']:
                 user_id = str(player_data['user']['id'])
-                user_name = player_data['user']['name']
-                player = self.get_player(user_id, user_name)
+                primary_id = get_primary_id(user_id, user_id)
+                player = get_rated_player(primary_id)
+                if player is None:
+                    player = Player(primary_id, player_data['user']['name'], self.default_mu, self.default_sigma)
+                    self.player_ratings[primary_id] = player
                 pick_order = player_data['pickOrder'] if player_data['pickOrder'] is not None else 0
+                team_index = 0 if player_data['team'] == 1 else 1
 
-                is_win = winning_team == player_data['team']
-                is_recent_game = current_date >= threshold_date
-
-                player.add_game(is_win, current_date, is_recent_game)
+                player.add_game(team_wins[team_index], current_date, is_recent_game)
 
                 # Only count pick order if the player is not the captain
                 if player_data['captain'] == 0:
                     player.update_pick_order(pick_order)
 
-                player.secondary_ids.add(user_id)
+                # Associated IDs are only displayed in verbose output
+                if self.verbose_output:
+                    player.secondary_ids.add(user_id)
 
-                if player_data['team'] == 1:
-                    team1.append(player.rating)
-                    team1_ids.append(player.user_id)
-                else:
-                    team2.append(player.rating)
-                    team2_ids.append(player.user_id)
+                team_players[team_index].append(player)
 
             # Update ratings based on match result
-            self.update_ratings(team1, team1_ids, team2, team2_ids, winning_team)
+            self.update_ratings(team_players[0], team_players[1], winning_team)
         except KeyError as e:
             handle_error(e, f"Failed to process game {game}")
 
-    def update_ratings(self, team1, team1_ids, team2, team2_ids, winning_team):
+    def update_ratings(self, team1_players, team2_players, winning_team):
         if winning_team == 1:
-            new_team1_ratings, new_team2_ratings = rate([team1, team2])
-            self.update_team_stats(team1_ids, new_team1_ratings)
-            self.update_team_stats(team2_ids, new_team2_ratings)
+            self.rate_win(team1_players, team2_players)
         else:
-            new_team2_ratings, new_team1_ratings = rate([team2, team1])
-            self.update_team_stats(team2_ids, new_team2_ratings)
-            self.update_team_stats(team1_ids, new_team1_ratings)
-
-    def update_team_stats(self, team_ids, new_ratings):
-        for i, user_id in enumerate(team_ids):
-            player = self.player_ratings[user_id]
-            player.rating = new_ratings[i]
+            self.rate_win(team2_players, team1_players)
+
+    def rate_win(self, winners, losers):
+        env = self.ts_env
+        if not winners or not losers:
+            # Same error trueskill's rate raises for an empty team
+            raise ValueError("Each group must contain multiple ratings")
+
+        # Closed-form TrueSkill update for two teams
+        # Priors are read before any writes since one player can appear twice when aliases share a game
+        tau_squared = env.tau ** 2
+        winner_priors = [(player.mu, player.sigma ** 2 + tau_squared) for player in winners]
+        loser_priors = [(player.mu, player.sigma ** 2 + tau_squared) for player in losers]
+        size = len(winners) + len(losers)
+        c_squared = (sum(variance for _, variance in winner_priors) + sum(variance for _, variance in loser_priors)
+                     + size * env.beta ** 2)
+        c = math.sqrt(c_squared)
+        mean_difference = sum(mu for mu, _ in winner_priors) - sum(mu for mu, _ in loser_priors)
+        draw_margin = calc_draw_margin(env.draw_probability, size, env)
+        v = env.v_win(mean_difference / c, draw_margin / c)
+        w = env.w_win(mean_difference / c, draw_margin / c)
+
+        for player, (mu, variance) in zip(winners, winner_priors):
+            player.mu = mu + variance / c * v
+            player.sigma = math.sqrt(variance * (1 - variance / c_squared * w))
+        for player, (mu, variance) in zip(losers, loser_priors):
+            player.mu = mu - variance / c * v
+            player.sigma = math.sqrt(variance * (1 - variance / c_squared * w))
 
     def apply_decay(self, played_dates):
-        previous_date = None
-        for date in sorted(played_dates.keys()):
-            participants = played_dates[date]
-            if previous_date:
-                for player_id in self.player_ratings:
-                    primary_id = self.get_primary_id(player_id)
-                    if primary_id not in participants:
-                        days_inactive = (date - self.player_ratings[primary_id].last_played).days
-                        if days_inactive > self.grace_days:
-                            self.player_ratings[primary_id].apply_sigma_decay(self.decay_amount,
-                                                                              self.max_decay_proportion, days_inactive,
-                                                                              self.default_sigma)
-            previous_date = date
+        if not played_dates:
+            return
+        # Decay each player once for their inactivity up to the last date any games were played
+        last_date = max(played_dates)
+        for player in self.player_ratings.values():
+            days_inactive = (last_date - player.last_played).days
+            if days_inactive > self.grace_days:
+                player.apply_sigma_decay(self.decay_amount, self.max_decay_proportion, days_inactive,
+                                         self.default_sigma)
 
     def run(self):
         start_date_str = datetime.fromtimestamp(int(self.start_date) / 1000, self.timezone).strftime('%Y-%m-%d')
@@ -211,10 +246,20 @@ class GameProcessor:
         else:
             games = self.fetch_game_data()
 
-        played_dates = {}
+        # Rate games in the order they were completed
+        try:
+            games.sort(key=itemgetter('completionTimestamp'))
+        except KeyError as e:
+            handle_error(e, "Failed to sort games by completionTimestamp")
+
+        played_dates = set()
+
+        # Games on or after this date count towards a player's recent games
+        now_date = datetime.now(self.timezone).date()
+        threshold_date = now_date - timedelta(days=self.last_days_threshold)
 
         for game in games:
-            self.process_game(game, played_dates)
+            self.process_game(game, played_dates, threshold_date)
 
         if self.decay_enabled:
             self.apply_decay(played_dates)
@@ -1,8 +1,21 @@
 # Standard
+import json
 import sys
+# Optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def handle_error(exception, msg):
     print(f"Error: {msg}")
     print(f"Exception: {str(exception)}")
     sys.exit(1)
+
+
+def parse_json(data):
+    # Use orjson when it is installed, otherwise the standard library
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -1,17 +1,48 @@
 # External
 import pytz
+import requests_mock
 # Standard
+import csv
+import io
+import json
+import os
+import re
+import tempfile
 import unittest
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch, mock_open
 from datetime import datetime, timedelta
 # Internal
 from process import Player, GameProcessor
 from output import display_ratings
 
+# Timezone used by the tests and today's date in it
+SYDNEY_TZ = pytz.timezone("Australia/Sydney")
+TODAY_SYD = datetime.now(SYDNEY_TZ).date()
+# Fixed clock for tests that don't depend on the real current date
+FIXED_NOW = SYDNEY_TZ.localize(datetime(2024, 6, 1, 12, 0))
+# Formatted the same way as the end date in GameProcessor.run
+END_DATE_STR = FIXED_NOW.strftime('%Y-%m-%d %I:%M %p %Z')
+# The ten days up to FIXED_NOW on which games were played in test_apply_decay
+_DECAY_DATES = [FIXED_NOW.date() - timedelta(days=i) for i in range(10)]
+# A single game won by team 1, process_game only reads it
+_GAME_DATA_FIXTURE = {
+    "completionTimestamp": 1609459200000,
+    "players": [
+        {"user": {"id": "1", "name": "Player1"}, "team": 1, "captain": 0, "pickOrder": 3},
+        {"user": {"id": "2", "name": "Player2"}, "team": 2, "captain": 0, "pickOrder": 2}
+    ],
+    "winningTeam": 1
+}
+
+
+def _make_player(number):
+    # Fresh player each time, tests change the counters and secondary_ids set
+    return Player(str(number), f'Player{number}', 25.0, 8.333)
+
 
 class TestPlayer(unittest.TestCase):
     def setUp(self):
-        self.player = Player('1', 'Player1', 25.0, 8.333)
+        self.player = _make_player(1)
 
     def test_update_pick_order(self):
         self.player.update_pick_order(3)
@@ -20,7 +51,7 @@ class TestPlayer(unittest.TestCase):
         self.assertEqual(self.player.avg_pick_order, 3.0)
 
     def test_add_game(self):
-        today = datetime.now().date()
+        today = FIXED_NOW.date()
         self.player.add_game(True, today, True)
         self.assertEqual(self.player.games_played, 1)
         self.assertEqual(self.player.wins, 1)
@@ -33,120 +64,294 @@ class TestPlayer(unittest.TestCase):
 
 
 class TestGameProcessor(unittest.TestCase):
-    def setUp(self):
-        self.domain = "https://example.com"
-        self.server_id = "server123"
-        self.start_date = "1706338920000"  # 2024-01-27
-        self.timezone = pytz.timezone("Australia/Sydney")
-        self.min_games_required = 10
-        self.last_days_threshold = 30
-        self.min_games_last_days = 5
-        self.discard_ties = False
-        self.decay_enabled = True
-        self.decay_amount = 0.1
-        self.grace_days = 7
-        self.max_decay_proportion = 0.5
-        self.default_sigma = 8.333
-        self.default_mu = 25.0
-        self.verbose_output = False
-        self.top_x = 20
-        self.write_txt = False
-        self.write_csv = False
-        self.json_file = None
-        self.user_aliases = {"main": ["alias1", "alias2"]}
-
-        self.processor = GameProcessor(
-            self.domain, self.server_id, self.start_date, self.timezone, self.min_games_required,
-            self.last_days_threshold, self.min_games_last_days, self.discard_ties, self.decay_enabled,
-            self.decay_amount, self.grace_days, self.max_decay_proportion, self.default_sigma, self.default_mu,
-            self.verbose_output, self.top_x, self.write_txt, self.write_csv, self.json_file, self.user_aliases
+    @classmethod
+    def setUpClass(cls):
+        cls.domain = "https://example.com"
+        cls.server_id = "server123"
+        cls.start_date = "1706338920000"  # 2024-01-27
+        cls.timezone = SYDNEY_TZ
+        cls.min_games_required = 10
+        cls.last_days_threshold = 30
+        cls.min_games_last_days = 5
+        cls.discard_ties = False
+        cls.decay_enabled = True
+        cls.decay_amount = 0.1
+        cls.grace_days = 7
+        cls.max_decay_proportion = 0.5
+        cls.default_sigma = 8.333
+        cls.default_mu = 25.0
+        cls.verbose_output = False
+        cls.top_x = 20
+        cls.write_txt = False
+        cls.write_csv = False
+        cls.json_file = None
+        cls.user_aliases = {"main": ["alias1", "alias2"]}
+
+        # Shared by the tests, setUp resets the state they change
+        cls.processor = GameProcessor(
+            cls.domain, cls.server_id, cls.start_date, cls.timezone, cls.min_games_required,
+            cls.last_days_threshold, cls.min_games_last_days, cls.discard_ties, cls.decay_enabled,
+            cls.decay_amount, cls.grace_days, cls.max_decay_proportion, cls.default_sigma, cls.default_mu,
+            cls.verbose_output, cls.top_x, cls.write_txt, cls.write_csv, cls.json_file, cls.user_aliases
         )
 
-    @patch('requests.get')
-    def test_fetch_game_data(self, mock_get):
-        mock_response = MagicMock()
-        mock_response.json.return_value = {"key": "value"}
-        mock_response.status_code = 200
-        mock_get.return_value = mock_response
+    def setUp(self):
+        self.processor.player_ratings = {}
+        self.processor.games_used_count = 0
+        self.processor.json_file = None
+        self.processor.local_day_bounds = (0, 0, None)
+
+    def _seed_two_players(self):
+        player1, player2 = _make_player(1), _make_player(2)
+        self.processor.player_ratings = {'1': player1, '2': player2}
+        return player1, player2
 
-        data = self.processor.fetch_game_data()
+    def test_fetch_game_data(self):
+        with requests_mock.Mocker() as mock_requests:
+            mock_requests.get(requests_mock.ANY, content=b'{"key": "value"}')
+            data = self.processor.fetch_game_data()
         self.assertEqual(data, {"key": "value"})
+        self.assertEqual(mock_requests.call_count, 1)
+        self.assertEqual(mock_requests.last_request.url, self.processor.url)
+        self.assertEqual(mock_requests.last_request.timeout, 30)
+
+    @patch('process.handle_error')
+    def test_fetch_game_data_invalid_json(self, mock_handle_error):
+        with requests_mock.Mocker() as mock_requests:
+            mock_requests.get(requests_mock.ANY, content=b'<html>')
+            self.processor.fetch_game_data()
+        mock_handle_error.assert_called_once()
+        self.assertEqual(mock_handle_error.call_args.args[1], f"Failed to fetch data from {self.processor.url}")
 
-    @patch('builtins.open', new_callable=mock_open, read_data='{"key": "value"}')
-    def test_read_game_data_from_file(self, mock_file):
+    def test_read_game_data_from_file(self):
         self.processor.json_file = "dummy_path"
-        data = self.processor.read_game_data_from_file()
+        with patch('builtins.open', mock_open(read_data=b'{"key": "value"}')) as mock_file:
+            data = self.processor.read_game_data_from_file()
         self.assertEqual(data, {"key": "value"})
-        mock_file.assert_called_once_with("dummy_path", 'r')
+        mock_file.assert_called_once_with("dummy_path", 'rb')
 
-    def test_get_primary_id(self):
-        self.assertEqual(self.processor.get_primary_id("alias1"), "main")
-        self.assertEqual(self.processor.get_primary_id("unknown"), "unknown")
+    def test_alias_to_primary(self):
+        self.assertEqual(self.processor.alias_to_primary, {"alias1": "main", "alias2": "main"})
 
-    def test_get_player(self):
-        player = self.processor.get_player("1", "Player1")
-        self.assertEqual(player.user_id, "1")
-        self.assertEqual(player.name, "Player1")
+    def test_get_local_date_across_midnight_dst_end(self):
+        # Havana left DST at 01:00 on 2015-11-01, repeating the first hour of the day
+        havana = pytz.timezone("America/Havana")
+        start_ms = int(datetime(2015, 10, 31, 20, 0, tzinfo=pytz.utc).timestamp() * 1000)
+        end_ms = int(datetime(2015, 11, 1, 12, 0, tzinfo=pytz.utc).timestamp() * 1000)
+        with patch.object(self.processor, 'timezone', havana):
+            for timestamp_ms in range(start_ms, end_ms, 4 * 60 * 1000):
+                self.assertEqual(self.processor.get_local_date(timestamp_ms),
+                                 datetime.fromtimestamp(timestamp_ms / 1000, havana).date())
 
-    def test_process_game(self):
-        player1 = Player('1', 'Player1', 25.0, 8.333)
-        player2 = Player('2', 'Player2', 25.0, 8.333)
-        self.processor.player_ratings = {'1': player1, '2': player2}
+    def test_process_game_creates_players(self):
         game_data = {
             "completionTimestamp": 1609459200000,
             "players": [
-                {"user": {"id": "1", "name": "Player1"}, "team": 1, "captain": 0, "pickOrder": 3},
-                {"user": {"id": "2", "name": "Player2"}, "team": 2, "captain": 0, "pickOrder": 2}
+                {"user": {"id": "alias1", "name": "Alias1"}, "team": 1, "captain": 0, "pickOrder": 1},
+                {"user": {"id": "3", "name": "Player3"}, "team": 2, "captain": 0, "pickOrder": 1}
             ],
             "winningTeam": 1
         }
-        played_dates = {}
-        self.processor.process_game(game_data, played_dates)
+        self.processor.process_game(game_data, set(), FIXED_NOW.date())
+        # Aliased IDs are rated under their primary name, other IDs under themselves
+        self.assertEqual(set(self.processor.player_ratings), {"main", "3"})
+        player = self.processor.player_ratings["3"]
+        self.assertEqual(player.user_id, "3")
+        self.assertEqual(player.name, "Player3")
+        self.assertEqual(player.games_played, 1)
+
+    def _run_with_games(self, games):
+        self.processor.player_ratings = {}
+        self.processor.games_used_count = 0
+        self.processor.local_day_bounds = (0, 0, None)
+        self.processor.json_file = "dummy_path"
+        with patch('builtins.open', mock_open(read_data=json.dumps(games).encode())), \
+                patch('process.display_ratings'):
+            self.processor.run()
+        return {user_id: (player.mu, player.sigma, player.last_played)
+                for user_id, player in self.processor.player_ratings.items()}
+
+    def test_run_sorts_games_by_completion(self):
+        def game(timestamp, winner, loser):
+            return {
+                "completionTimestamp": timestamp,
+                "players": [
+                    {"user": {"id": winner, "name": f"Player{winner}"}, "team": 1, "captain": 0, "pickOrder": 1},
+                    {"user": {"id": loser, "name": f"Player{loser}"}, "team": 2, "captain": 0, "pickOrder": 1}
+                ],
+                "winningTeam": 1
+            }
+
+        # One game a day from 2021-01-01, rating results depend on the order they are processed in
+        day_ms = 24 * 60 * 60 * 1000
+        sorted_games = [game(1609459200000, "1", "2"), game(1609459200000 + day_ms, "2", "1"),
+                        game(1609459200000 + 2 * day_ms, "1", "3")]
+        expected = self._run_with_games(sorted_games)
+        shuffled = self._run_with_games([sorted_games[2], sorted_games[0], sorted_games[1]])
+
+        self.assertEqual(shuffled, expected)
+        self.assertEqual(shuffled["1"][2], datetime(2021, 1, 3).date())
+        self.assertEqual(shuffled["2"][2], datetime(2021, 1, 2).date())
+
+    def test_process_game(self):
+        self._seed_two_players()
+        played_dates = set()
+        threshold_date = FIXED_NOW.date() - timedelta(days=self.last_days_threshold)
+        self.processor.process_game(_GAME_DATA_FIXTURE, played_dates, threshold_date)
         self.assertEqual(self.processor.games_used_count, 1)
-        self.assertIn(datetime(2021, 1, 1, tzinfo=self.timezone).date(), played_dates)
-        self.assertIn("1", played_dates[datetime(2021, 1, 1, tzinfo=self.timezone).date()])
+        expected_date = datetime(2021, 1, 1, tzinfo=self.timezone).date()
+        self.assertEqual(played_dates, {expected_date})
+
+    def test_process_game_team_two_win(self):
+        player1, player2 = self._seed_two_players()
+        game_date = datetime(2021, 1, 1).date()
+        self.processor.process_game(dict(_GAME_DATA_FIXTURE, winningTeam=2), set(), game_date)
+        self.assertEqual((player1.wins, player1.losses), (0, 1))
+        self.assertEqual((player2.wins, player2.losses), (1, 0))
+        # Played on the threshold date, so the game counts as recent
+        self.assertEqual((player1.recent_games, player2.recent_games), (1, 1))
+        self.assertEqual((player1.total_pick_order, player1.pick_order_count), (3, 1))
+        self.assertEqual((player2.total_pick_order, player2.pick_order_count), (2, 1))
+
+    def test_process_game_tie(self):
+        player1, player2 = self._seed_two_players()
+        self.processor.process_game(dict(_GAME_DATA_FIXTURE, winningTeam=0), set(), FIXED_NOW.date())
+        # Neither team wins a tie, so both players take a loss
+        self.assertEqual((player1.wins, player1.losses), (0, 1))
+        self.assertEqual((player2.wins, player2.losses), (0, 1))
+        self.assertEqual((player1.recent_games, player2.recent_games), (0, 0))
+
+    def test_process_game_secondary_ids_only_when_verbose(self):
+        game_data = dict(_GAME_DATA_FIXTURE, players=[
+            {"user": {"id": "alias1", "name": "Alias1"}, "team": 1, "captain": 0, "pickOrder": 1},
+            {"user": {"id": "2", "name": "Player2"}, "team": 2, "captain": 0, "pickOrder": 1}
+        ])
+        self.processor.process_game(game_data, set(), FIXED_NOW.date())
+        self.assertEqual(self.processor.player_ratings["main"].secondary_ids, set())
+        with patch.object(self.processor, 'verbose_output', True):
+            self.processor.process_game(game_data, set(), FIXED_NOW.date())
+        self.assertEqual(self.processor.player_ratings["main"].secondary_ids, {"alias1"})
 
     def test_update_ratings(self):
-        player1 = Player('1', 'Player1', 25.0, 8.333)
-        player2 = Player('2', 'Player2', 25.0, 8.333)
-        self.processor.player_ratings = {'1': player1, '2': player2}
-        team1 = [player1.rating]
-        team2 = [player2.rating]
-        self.processor.update_ratings(team1, ['1'], team2, ['2'], 1)
+        player1, player2 = self._seed_two_players()
+        self.processor.update_ratings([player1], [player2], 1)
         self.assertGreater(self.processor.player_ratings['1'].rating.mu, 25.0)
         self.assertLess(self.processor.player_ratings['2'].rating.mu, 25.0)
 
+    def _assert_matches_trueskill(self, winners, losers):
+        expected_winners, expected_losers = self.processor.ts_env.rate([[player.rating for player in winners],
+                                                                         [player.rating for player in losers]])
+        # A player listed twice keeps the rating of their last entry, as when assigning env.rate's results
+        expected = {}
+        for player, rating in zip(winners + losers, expected_winners + expected_losers):
+            expected[id(player)] = (player, rating)
+        self.processor.rate_win(winners, losers)
+        for player, rating in expected.values():
+            self.assertAlmostEqual(player.mu, rating.mu, places=9)
+            self.assertAlmostEqual(player.sigma, rating.sigma, places=9)
+
+    def test_rate_win_matches_trueskill(self):
+        player1, player2 = _make_player(1), _make_player(2)
+        self._assert_matches_trueskill([player1], [player2])
+
+    def test_rate_win_matches_trueskill_unequal_teams(self):
+        players = [Player(str(i), f'Player{i}', 20.0 + i, 3.0 + i / 2) for i in range(5)]
+        self._assert_matches_trueskill(players[:2], players[2:])
+
+    def test_rate_win_matches_trueskill_aliased_player(self):
+        # One player entered twice through aliases sharing a game
+        players = [Player(str(i), f'Player{i}', 20.0 + i, 3.0 + i / 2) for i in range(4)]
+        self._assert_matches_trueskill([players[0], players[1], players[0]], players[2:])
+
+    def test_rate_win_empty_team(self):
+        with self.assertRaises(ValueError):
+            self.processor.rate_win([_make_player(1)], [])
+
     def test_apply_decay(self):
-        player = Player('1', 'Player1', 25.0, 8.333)
-        player.last_played = datetime.now(self.timezone).date() - timedelta(days=10)
+        player = _make_player(1)
+        player.last_played = FIXED_NOW.date() - timedelta(days=10)
         self.processor.player_ratings = {'1': player}
-        played_dates = {datetime.now(self.timezone).date() - timedelta(days=i): set() for i in range(10)}
+        played_dates = set(_DECAY_DATES)
         self.processor.apply_decay(played_dates)
         self.assertGreaterEqual(self.processor.player_ratings['1'].rating.sigma, 8.333)
 
-    @patch('sys.stdout', new_callable=unittest.mock.MagicMock)
-    def test_display_ratings(self, mock_stdout):
-        player = Player('1', 'Player1', 25.0, 8.333)
+    def test_apply_decay_once_per_player(self):
+        # Both players start below the cap of default_sigma * max_decay_proportion
+        inactive_player, grace_player = self._seed_two_players()
+        inactive_player.sigma = grace_player.sigma = 2.0
+        inactive_player.last_played = FIXED_NOW.date() - timedelta(days=12)
+        grace_player.last_played = FIXED_NOW.date() - timedelta(days=self.grace_days)
+        self.processor.apply_decay(set(_DECAY_DATES))
+        # Decay covers all 12 inactive days once, however many played dates follow the last game
+        self.assertAlmostEqual(inactive_player.sigma, 2.0 + self.decay_amount * 12)
+        self.assertEqual(grace_player.sigma, 2.0)
+
+    def test_display_ratings(self):
+        player = _make_player(1)
         player.games_played = 20
-        player.last_played = datetime.now(self.timezone).date()
+        player.last_played = TODAY_SYD
         self.processor.player_ratings = {'1': player}
 
-        # Generate the end_date_str in the same way it's generated in the run method
-        end_date_str = datetime.now(self.timezone).strftime('%Y-%m-%d %I:%M %p %Z')
+        # Call the actual display_ratings method, capturing what it prints
+        stream = io.StringIO()
+        display_ratings(self.processor, "2021-01-01", END_DATE_STR, stream)
+        output = stream.getvalue()
+
+        expected_lines = [
+            f"Games period: From 2021-01-01 to {END_DATE_STR}",
+            "Games used: 0",
+            "Sigma decay: decay_amount=0.1, grace_days=7, max_decay_proportion=0.5",
+            "Minimum games required: 10 (0 players filtered)",
+            "Ties discarded: False",
+            "Aliased player/s: ",
+        ]
+        # Every expected line must appear in the output
+        pattern = re.compile("|".join(re.escape(line) for line in expected_lines))
+        self.assertEqual(set(pattern.findall(output)), set(expected_lines))
+
 
-        # Call the actual display_ratings method
-        display_ratings(self.processor, "2021-01-01", end_date_str, mock_stdout)
+    def test_display_ratings_filters(self):
+        players = [_make_player(number) for number in range(1, 5)]
+        for player in players:
+            player.games_played = player.recent_games = 20
+            player.last_played = TODAY_SYD
+        players[0].games_played = 5
+        players[1].last_played = TODAY_SYD - timedelta(days=self.last_days_threshold + 1)
+        players[2].recent_games = 2
+        self.processor.player_ratings = {player.user_id: player for player in players}
+
+        stream = io.StringIO()
+        display_ratings(self.processor, "2021-01-01", END_DATE_STR, stream)
+        output = stream.getvalue()
+
+        # Each of the first three players fails one filter, only Player4 is shown
+        self.assertEqual(self.processor.filtered_by_min_games, 1)
+        self.assertEqual(self.processor.filtered_by_last_days, 1)
+        self.assertEqual(self.processor.filtered_by_min_games_last_days, 1)
+        self.assertEqual(re.findall(r"Player\d", output), ["Player4"])
+
+    def test_display_ratings_csv_keeps_discord_ids_in_one_field(self):
+        player = _make_player(1)
+        player.games_played = player.recent_games = 20
+        player.last_played = TODAY_SYD
+        player.secondary_ids.update({"111", "222"})
+        self.processor.player_ratings = {'1': player}
 
-        # Check the calls to the write method
-        output = mock_stdout.write.call_args_list
+        previous_dir = os.getcwd()
+        with tempfile.TemporaryDirectory() as out_dir, \
+                patch.object(self.processor, 'write_csv', True), patch.object(self.processor, 'verbose_output', True):
+            os.chdir(out_dir)
+            try:
+                display_ratings(self.processor, "2021-01-01", END_DATE_STR, io.StringIO())
+                csv_filename, = os.listdir("out")
+                with open(os.path.join("out", csv_filename), encoding="utf-8", newline="") as csv_file:
+                    header, row = csv.reader(csv_file)
+            finally:
+                os.chdir(previous_dir)
 
-        self.assertTrue(any(f"Games period: From 2021-01-01 to {end_date_str}" in str(call) for call in output))
-        self.assertTrue(any("Games used: 0" in str(call) for call in output))
-        self.assertTrue(any("Sigma decay: decay_amount=0.1, grace_days=7, max_decay_proportion=0.5"
-                            in str(call) for call in output))
-        self.assertTrue(any("Minimum games required: 10 (0 players filtered)" in str(call) for call in output))
-        self.assertTrue(any("Ties discarded: False" in str(call) for call in output))
-        self.assertTrue(any("Aliased player/s: " in str(call) for call in output))
+        self.assertEqual(len(header), 10)
+        self.assertEqual(len(row), 10)
+        self.assertEqual(set(row[-1].split(",")), {"111", "222"})
 
 
 if __name__ == '__main__':